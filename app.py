@@ -1,9 +1,14 @@
 import streamlit as st
 import pandas as pd
 import altair as alt
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
+import io
 import requests
+from requests.adapters import HTTPAdapter
+import pyarrow as pa
+import pyarrow.csv as pacsv
 import numpy as np  # For mock scoring
+from kernels import ar_metrics, priority_scores
 
 # --------------------------- CONFIG ---------------------------
 st.set_page_config(page_title="Custom AR Management Tool", layout="wide")
@@ -15,21 +20,52 @@ API_KEY = st.secrets.get("NIKO_API_KEY", None)
 USE_REAL_API = API_KEY is not None
 API_BASE = "https://api.nikohealth.com"
 
+@st.cache_resource
+def _get_session():
+    # One pooled session per process (survives reruns) so repeat fetches reuse the TCP/TLS connection
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
+    return session
+
+# Payer risk lookup, aligned with PAYERS; the trailing entry is the fallback for unknown payers (code -1)
+PAYERS = ["Medicare", "Blue Cross", "Aetna", "UnitedHealthcare"]
+PAYER_RISK = np.array([0.2, 0.4, 0.6, 0.5, 0.3], dtype=np.float32)
+
+CATEGORY_COLS = ("payer_name", "status", "denial_reason")  # Low-cardinality strings stored as int codes
+
+AGING_BINS = [0, 30, 60, 90, np.inf]
+AGING_LABELS = ["0-30", "31-60", "61-90", "90+"]
+
 # --------------------------- DATA FETCH (Mock + Real) ---------------------------
-@st.cache_data(ttl=600, show_spinner="Loading AR data...")
-def fetch_ar_data(start_date, end_date):
+@st.cache_resource(ttl=600, show_spinner="Loading AR data...")
+def _fetch_ar_data(start_ord, end_ord):
+    # Keyed on date ordinals: plain ints are cheaper and more stable to hash than date objects.
+    # cache_resource hands every rerun the same DataFrame (no pickle roundtrip), so treat it as read-only.
+    start_date, end_date = date.fromordinal(start_ord), date.fromordinal(end_ord)
+    today = np.datetime64("today", "D")
+    rng = np.random.default_rng(seed=hash((start_ord, end_ord)) & 0xFFFFFFFF)  # Deterministic per cache key
     if USE_REAL_API:
         # === REAL NIKOHEALTH INTEGRATION ===
         headers = {"Authorization": f"Bearer {API_KEY}"}
         params = {"start_date": start_date.strftime("%Y-%m-%d"), "end_date": end_date.strftime("%Y-%m-%d"), "limit": 1000}
         try:
             # Pull payments + adjustments for AR (customize endpoints as needed)
-            response = requests.get(f"{API_BASE}/v2/payments", headers=headers, params=params, timeout=20)
+            response = _get_session().get(f"{API_BASE}/v2/payments", headers=headers, params=params, timeout=(3.05, 20))
             if response.status_code == 200:
                 data = response.json().get("data", [])
                 df = pd.DataFrame(data)
-                df["aging_days"] = (pd.to_datetime("today") - pd.to_datetime(df["due_date"])).dt.days
-                df["denial_risk"] = np.where(df["status"] == "denied", 1.0, np.random.uniform(0.1, 0.8))  # Placeholder; use real ML
+                # Filled once so alerts read it branch-free; payloads may omit the field entirely
+                df["denial_reason"] = df.get("denial_reason", pd.Series("Low", index=df.index)).fillna("Low")
+                for c in CATEGORY_COLS:
+                    df[c] = df[c].astype("category")
+                # Undated rows can't be aged; an int32 cast would turn NaT into 0 and read them as current AR
+                due = pd.to_datetime(df["due_date"])
+                has_due = due.notna().to_numpy()
+                df = df[has_due].copy()
+                df["aging_days"] = (today - due.values[has_due].astype("datetime64[D]")).astype("int32")
+                df["aging_bucket"] = pd.cut(df["aging_days"], bins=AGING_BINS, labels=AGING_LABELS, include_lowest=True)
+                nonden = rng.uniform(0.1, 0.8, len(df))  # Per-row draw, not one broadcast scalar
+                df["denial_risk"] = np.where((df["status"] == "denied").to_numpy(), 1.0, nonden)  # Placeholder; use real ML
                 return df
             else:
                 st.error(f"API Error: {response.status_code}")
@@ -43,24 +79,25 @@ def fetch_ar_data(start_date, end_date):
         end_date_mock = datetime.now()
         start_date_mock = end_date_mock - timedelta(days=90)
         dates = pd.date_range(start=start_date_mock, end=end_date_mock, freq="D")
-        mock_data = []
-        payers = ["Medicare", "Blue Cross", "Aetna", "UnitedHealthcare"]
         reasons = ["CO-45: Charge exceeds fee", "PR-96: Non-covered", "CO-97: Duplicate", "CO-16: Missing info"]
-        for i, date in enumerate(dates):
-            mock_data.append({
-                "invoice_id": f"INV-{i+1000}",
-                "patient_id": f"PT-{np.random.randint(1000, 2000)}",
-                "payer_name": np.random.choice(payers),
-                "amount_due": np.random.uniform(100, 2000),
-                "amount_paid": np.random.uniform(0, 1) * np.random.uniform(100, 2000),  # Partial payments
-                "status": np.random.choice(["open", "partial", "denied", "paid"], p=[0.4, 0.2, 0.3, 0.1]),
-                "due_date": date,
-                "last_followup": date - timedelta(days=np.random.randint(0, 30)),
-                "denial_reason": np.random.choice(reasons) if np.random.rand() > 0.7 else None,
-                "notes": "Follow-up pending" if np.random.rand() > 0.6 else ""
-            })
-        df = pd.DataFrame(mock_data)
-        df["aging_days"] = (pd.to_datetime("today") - pd.to_datetime(df["due_date"])).dt.days
+        N = len(dates)
+        # Build every column in one batched draw instead of a per-row loop
+        df = pd.DataFrame({
+            "invoice_id": pd.array(np.char.add("INV-", (np.arange(N) + 1000).astype("U")), dtype="string[pyarrow]"),
+            "patient_id": pd.array(np.char.add("PT-", rng.integers(1000, 2000, N).astype("U")), dtype="string[pyarrow]"),
+            "payer_name": pd.Categorical(rng.choice(PAYERS, N), categories=PAYERS),
+            "amount_due": rng.uniform(100, 2000, N),
+            "amount_paid": rng.uniform(0, 1, N) * rng.uniform(100, 2000, N),  # Partial payments
+            "status": rng.choice(["open", "partial", "denied", "paid"], N, p=[0.4, 0.2, 0.3, 0.1]),
+            "due_date": dates,
+            "last_followup": dates - pd.to_timedelta(rng.integers(0, 30, N), unit="D"),
+            "denial_reason": np.where(rng.random(N) > 0.7, rng.choice(reasons, N), "Low"),
+            "notes": np.where(rng.random(N) > 0.6, "Follow-up pending", ""),
+        })
+        for c in CATEGORY_COLS:
+            df[c] = df[c].astype("category")
+        df["aging_days"] = (today - df["due_date"].values.astype("datetime64[D]")).astype("int32")
+        df["aging_bucket"] = pd.cut(df["aging_days"], bins=AGING_BINS, labels=AGING_LABELS, include_lowest=True)  # Binned once, reused by table + chart
         df["outstanding"] = df["amount_due"] - df["amount_paid"]
         df["priority_score"] = calculate_priority(df)  # AI-like scoring
         return df
@@ -68,11 +105,23 @@ def fetch_ar_data(start_date, end_date):
 def calculate_priority(df):
     """Mock AI Prioritization: Score 0-1 based on aging, risk, payer"""
     # Inspired by Thoughtful.ai: High aging + denial risk = high priority
-    payer_risk = {"Medicare": 0.2, "Blue Cross": 0.4, "Aetna": 0.6, "UnitedHealthcare": 0.5}
-    df["payer_risk"] = df["payer_name"].map(payer_risk).fillna(0.3)
-    risk = np.where(df["status"] == "denied", 1.0, 0.5)  # Boost denials
-    score = (df["aging_days"] / 90) * 0.4 + df["payer_risk"] * 0.3 + risk * 0.3
-    return np.clip(score, 0, 1)
+    codes = pd.Categorical(df["payer_name"], categories=PAYERS).codes  # Re-codes onto PAYERS order; unknown payers -> -1 -> 0.3 fallback
+    df["payer_risk"] = PAYER_RISK[codes]
+    score = np.empty(len(df), dtype=np.float32)  # 0-1 score shown to 2 decimals; money columns stay float64
+    priority_scores(df["aging_days"].to_numpy(), df["payer_risk"].to_numpy(), (df["status"] == "denied").to_numpy(), score)
+    return score
+
+@st.cache_resource(ttl=600, show_spinner=False)
+def filter_ar(start_ord, end_ord, min_priority):
+    """Priority-filtered open AR, cached so revisiting a slider value skips recomputing the mask"""
+    # Shared like _fetch_ar_data: returned without copying, so callers must not mutate it
+    df = _fetch_ar_data(start_ord, end_ord)
+    if df.empty:
+        return df
+    mask = df["outstanding"].values > 0  # Focus on open AR
+    if min_priority > 0.0:  # Scores are clipped to [0, 1], so a zero threshold keeps every row
+        mask &= df["priority_score"].values >= min_priority
+    return df.iloc[mask.nonzero()[0]]
 
 # --------------------------- UI: Filters & Load ---------------------------
 st.sidebar.header("Filters")
@@ -81,20 +130,15 @@ start_date = col1.date_input("Start Date", datetime.now() - timedelta(days=90))
 end_date = col2.date_input("End Date", datetime.now())
 min_priority = st.sidebar.slider("Min Priority Score", 0.0, 1.0, 0.3)
 
-df = fetch_ar_data(start_date, end_date)
+df = filter_ar(start_date.toordinal(), end_date.toordinal(), min_priority)
 if df.empty:
     st.warning("No data in range. Adjust filters.")
     st.stop()
 
-df = df[df["priority_score"] >= min_priority].copy()
-df = df[df["outstanding"] > 0]  # Focus on open AR
-
 # --------------------------- KEY METRICS (Thoughtful.ai-Style) ---------------------------
 col1, col2, col3, col4 = st.columns(4)
-total_ar = df["outstanding"].sum()
-total_accounts = len(df)
-avg_dso = df["aging_days"].mean()  # Days Sales Outstanding proxy
-recovery_potential = (df["outstanding"] * 0.8).sum()  # Assume 80% recoverable
+# avg_dso is a Days Sales Outstanding proxy
+total_ar, avg_dso, recovery_potential, total_accounts = ar_metrics(df["outstanding"].to_numpy(), df["aging_days"].to_numpy())
 
 with col1:
     st.metric("Total AR", f"${total_ar:,.0f}")
@@ -109,9 +153,11 @@ st.markdown("---")
 
 # --------------------------- PRIORITIZED ACCOUNTS TABLE ---------------------------
 st.subheader("🔥 High-Priority Accounts (AI-Scored)")
-priority_df = df.sort_values("priority_score", ascending=False).head(10).copy()
+scores = df["priority_score"].to_numpy()
+top_idx = np.argpartition(scores, -10)[-10:] if len(scores) > 10 else np.arange(len(scores))  # Top-10 without a full sort
+top_idx = top_idx[np.argsort(-scores[top_idx])]
+priority_df = df.iloc[top_idx].copy()
 priority_df["priority_score"] = (priority_df["priority_score"] * 100).round(0).astype(int)
-priority_df["aging_bucket"] = pd.cut(priority_df["aging_days"], bins=[0, 30, 60, 90, np.inf], labels=["0-30", "31-60", "61-90", "90+"])
 priority_df["next_action"] = np.where(priority_df["aging_days"] > 60, "Escalate to Collector", "Auto-Followup Email")
 
 display_cols = ["invoice_id", "patient_id", "payer_name", "outstanding", "aging_days", "priority_score", "next_action", "denial_reason"]
@@ -122,20 +168,19 @@ col1, col2 = st.columns(2)
 
 with col1:
     st.subheader("AR Aging Breakdown")
-    aging_pivot = df.groupby("aging_bucket")["outstanding"].sum().reset_index()
-    aging_chart = alt.Chart(aging_pivot).mark_bar(color="#FF6B6B").encode(
+    # Vega-Lite aggregates the long-form slice client-side; no pandas groupby on rerun
+    aging_chart = alt.Chart(df[["aging_bucket", "outstanding"]]).mark_bar(color="#FF6B6B").encode(
         x="aging_bucket:N",
-        y="outstanding:Q"
+        y="sum(outstanding):Q"
     ).properties(height=250)
     st.altair_chart(aging_chart, use_container_width=True)
 
 with col2:
     st.subheader("Priority Distribution")
-    prio_bins = pd.cut(df["priority_score"], bins=3, labels=["Low", "Med", "High"])
-    prio_count = df.groupby(prio_bins).size().reset_index(name="count")
-    prio_chart = alt.Chart(prio_count).mark_bar(color="#4ECDC4").encode(
+    prio_bins = pd.cut(df["priority_score"], bins=3, labels=["Low", "Med", "High"]).rename("prio_bins")
+    prio_chart = alt.Chart(prio_bins.to_frame()).mark_bar(color="#4ECDC4").encode(
         x="prio_bins:N",
-        y="count:Q"
+        y="count():Q"
     ).properties(height=250)
     st.altair_chart(prio_chart, use_container_width=True)
 
@@ -143,12 +188,15 @@ with col2:
 st.subheader("🚨 Predictive Alerts")
 high_risk = df[(df["priority_score"] > 0.7) & (df["aging_days"] > 45)]
 if not high_risk.empty:
-    for _, row in high_risk.head(5).iterrows():
-        with st.expander(f"Alert: {row['payer_name']} - {row['invoice_id']} (Risk: {row['priority_score']:.2f})"):
-            st.write(f"**Outstanding**: ${row['outstanding']:.0f} | **Aging**: {row['aging_days']} days")
-            st.write(f"**Recommended**: Send portal check + email. Denial Risk: {row.get('denial_reason', 'Low')}")
-            if st.button("Log Follow-up", key=f"log_{row['invoice_id']}"):
-                st.success("Follow-up logged!")
+    alert_cols = ["payer_name", "invoice_id", "outstanding", "aging_days", "priority_score", "denial_reason"]
+    top5 = high_risk.nlargest(5, "priority_score")[alert_cols]
+    st.dataframe(top5, use_container_width=True, hide_index=True)
+    sel = st.selectbox("Log follow-up for", top5["invoice_id"])
+    row = top5[top5["invoice_id"] == sel].iloc[0]
+    st.write(f"**Outstanding**: ${row['outstanding']:.0f} | **Aging**: {row['aging_days']} days")
+    st.write(f"**Recommended**: Send portal check + email. Denial Risk: {row['denial_reason']}")
+    if st.button("Log Follow-up", key=f"log_{sel}"):
+        st.success("Follow-up logged!")
 else:
     st.success("No high-risk alerts today.")
 
@@ -156,8 +204,14 @@ else:
 st.subheader("Actions")
 col1, col2 = st.columns(2)
 with col1:
-    csv = df.to_csv(index=False).encode("utf-8")
-    st.download_button("Export AR CSV", csv, "ar_report.csv", "text/csv")
+    # Arrow's C writer, straight to bytes. Unlike df.to_csv it quotes every string cell and header,
+    # and writes tz-aware timestamps in UTC with a "Z" suffix. Microsecond units keep to_csv's
+    # fractional seconds without Arrow's nanosecond padding.
+    ts_cols = df.select_dtypes(["datetime", "datetimetz"]).columns
+    export_df = df.assign(**{c: df[c].dt.as_unit("us") for c in ts_cols})
+    csv_buf = io.BytesIO()
+    pacsv.write_csv(pa.Table.from_pandas(export_df, preserve_index=False), csv_buf)
+    st.download_button("Export AR CSV", csv_buf.getvalue(), "ar_report.csv", "text/csv")
 with col2:
     st.text_area("Add Global Notes", key="global_notes", height=100)
 
@@ -166,7 +220,7 @@ if not USE_REAL_API:
     **Go Live with NikoHealth**:
     1. Get API key from support@nikohealth.com
     2. Add to `.streamlit/secrets.toml`: `NIKO_API_KEY = "your_key"`
-    3. Customize `fetch_ar_data` for endpoints like `/v2/payments` & `/v1/tasks`
+    3. Customize `_fetch_ar_data` for endpoints like `/v2/payments` & `/v1/tasks`
     """)
 
 # Footer Metrics (Thoughtful.ai Claims Simulation)
@@ -0,0 +1,27 @@
+"""Numba kernels for the AR dashboard.
+
+Kept out of app.py so Streamlit's per-interaction script reruns reuse the
+compiled dispatchers instead of redefining (and reloading) them each time.
+"""
+from numba import njit
+
+
+@njit(cache=True)
+def priority_scores(aging, payer_risk, denied, out):
+    # Fused score + clip in a single sweep over the input arrays
+    for i in range(aging.shape[0]):
+        r = 1.0 if denied[i] else 0.5  # Boost denials
+        s = (aging[i] / 90.0) * 0.4 + payer_risk[i] * 0.3 + r * 0.3
+        out[i] = 0.0 if s < 0 else (1.0 if s > 1 else s)
+
+
+@njit(cache=True)
+def ar_metrics(outstanding, aging):
+    # Total AR, avg DSO, recovery potential and account count in one pass
+    s = 0.0
+    a = 0.0
+    n = outstanding.shape[0]
+    for i in range(n):
+        s += outstanding[i]
+        a += aging[i]
+    return s, a / n, s * 0.8, n  # Assume 80% recoverable